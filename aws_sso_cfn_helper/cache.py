@@ -0,0 +1,50 @@
+import json
+import os
+import pathlib
+import time
+
+CACHE_DIR = pathlib.Path.home() / '.cache' / 'aws-sso-cfn-helper'
+
+CACHE_DURATION = 24 * 60 * 60 # seconds
+
+class Cache:
+    def __init__(self, profile, region, ttl=CACHE_DURATION):
+        self.path = CACHE_DIR / '{}_{}.json'.format(profile or 'default', region or 'no-region')
+        self.ttl = ttl
+
+    @classmethod
+    def for_session(cls, session, ttl=CACHE_DURATION):
+        return cls(session.profile_name, session.region_name, ttl=ttl)
+
+    def _read(self):
+        try:
+            with self.path.open('r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, key, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        entry = self._read().get(key)
+        if not entry or time.time() - entry['timestamp'] > ttl:
+            return None
+        return entry['value']
+
+    def store(self, key, value):
+        data = self._read()
+        data[key] = {'timestamp': time.time(), 'value': value}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with tmp_path.open('w') as fp:
+                json.dump(data, fp)
+            os.replace(str(tmp_path), str(self.path))
+        except OSError:
+            pass
+
+    def clear(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
@@ -1,24 +1,64 @@
 import argparse
+import concurrent.futures
+import functools
 import sys
 
-import boto3
+from .cache import Cache
+
+BULK_LOOKUP_THRESHOLD = 5
+
+DESCRIBE_PERMISSION_SET_WORKERS = 16
 
 class LookupError(Exception):
     pass
 
+# Sessions and clients are cached per profile so in-process callers don't
+# pay for construction on every call. To use other clients (e.g., in tests),
+# construct Ids and PermissionSetArnLookup with them directly.
+@functools.lru_cache(maxsize=None)
+def _get_session(profile):
+    import boto3
+    return boto3.Session(profile_name=profile)
+
+@functools.lru_cache(maxsize=None)
+def _get_clients(profile):
+    session = _get_session(profile)
+    return session.client('sso-admin'), session.client('identitystore')
+
+def list_instances(sso_admin_client, cache=None):
+    if cache:
+        response = cache.load('instances')
+        if response is not None:
+            return response
+    response = sso_admin_client.list_instances()
+    response = {'Instances': [{
+        'InstanceArn': instance['InstanceArn'],
+        'IdentityStoreId': instance['IdentityStoreId'],
+    } for instance in response['Instances']]}
+    if cache:
+        cache.store('instances', response)
+    return response
+
 class Ids:
-    def __init__(self, sso_admin_client, args):
+    def __init__(self, sso_admin_client, args, cache=None):
         self._client = sso_admin_client
+        self._cache = cache
         self._instance_arn = args.instance_arn
         self._instance_arn_printed = False
         self._identity_store_id = args.identity_store_id
         self._identity_store_id_printed = False
+        self._instances_response = None
         self.suppress_print = False
 
     def _print(self, *args, **kwargs):
         if not self.suppress_print:
             print(*args, **kwargs)
 
+    def _fetch_instances(self):
+        if self._instances_response is None:
+            self._instances_response = list_instances(self._client, self._cache)
+        return self._instances_response
+
     @property
     def instance_arn(self):
         if self._instance_arn:
@@ -26,7 +66,7 @@ class Ids:
                 self._print("Using SSO instance {}".format(self._instance_arn.split('/')[-1]))
                 self._instance_arn_printed = True
             return self._instance_arn
-        response = self._client.list_instances()
+        response = self._fetch_instances()
         if len(response['Instances']) == 0:
             raise LookupError("No SSO instance found, please specify with --instance-arn")
         elif len(response['Instances']) > 1:
@@ -47,10 +87,10 @@ class Ids:
     def identity_store_id(self):
         if self._identity_store_id:
             if not self._identity_store_id_printed:
-                self._print("Using SSO identity store {}".format(identity_store_id))
+                self._print("Using SSO identity store {}".format(self._identity_store_id))
                 self._identity_store_id_printed = True
             return self._identity_store_id
-        response = self._client.list_instances()
+        response = self._fetch_instances()
         if len(response['Instances']) == 0:
             raise LookupError("No SSO instance found, please specify identity store with --identity-store-id or instance with --instance-arn")
         elif len(response['Instances']) > 1:
@@ -62,7 +102,7 @@ class Ids:
             self._identity_store_id_printed = True
             instance_arn = response['Instances'][0]['InstanceArn']
             instance_id = instance_arn.split('/')[-1]
-            if self._instance_arn and self._instance_arn != identity_store_id:
+            if self._instance_arn and self._instance_arn != instance_arn:
                 raise LookupError("SSO instance {} does not match given instance {}".format(instance_id, self._instance_arn.split('/')[-1]))
             else:
                 self._instance_arn = instance_arn
@@ -80,16 +120,21 @@ def main():
 
     parser.add_argument('--profile')
 
+    parser.add_argument('--refresh-cache', action='store_true', help='Ignore and replace cached SSO instance and permission set lookups')
+
     parser.add_argument('--error-if-not-found', '-e', action='store_true')
     parser.add_argument('--show-id', action='store_true', help='Print SSO instance/identity store id being used')
 
     args = parser.parse_args()
 
-    session = boto3.Session(profile_name=args.profile)
-    sso_admin_client = session.client('sso-admin')
-    identity_store_client = session.client('identitystore')
+    session = _get_session(args.profile)
+    sso_admin_client, identity_store_client = _get_clients(args.profile)
+
+    cache = Cache.for_session(session)
+    if args.refresh_cache:
+        cache.clear()
 
-    ids = Ids(sso_admin_client, args)
+    ids = Ids(sso_admin_client, args, cache=cache)
     ids.suppress_print = not args.show_id
 
     try:
@@ -102,11 +147,12 @@ def main():
         elif args.type == 'groups':
             if not args.value:
                 parser.error("Group name is required")
+            group_ids = lookup_groups_bulk(identity_store_client, ids, args.value)
             lines = []
             for name in args.value:
-                try:
-                    group_id = lookup_group_by_name(identity_store_client, ids, name)
-                except LookupError as e:
+                if name in group_ids:
+                    group_id = group_ids[name]
+                else:
                     if args.error_if_not_found:
                         print(format_lines(lines))
                         print("Group {} not found".format(name), file=sys.stderr)
@@ -117,11 +163,12 @@ def main():
         elif args.type == 'users':
             if not args.value:
                 parser.error("User name is required")
+            user_ids = lookup_users_bulk(identity_store_client, ids, args.value)
             lines = []
             for name in args.value:
-                try:
-                    user_id = lookup_user_by_name(identity_store_client, ids, name)
-                except LookupError as e:
+                if name in user_ids:
+                    user_id = user_ids[name]
+                else:
                     if args.error_if_not_found:
                         print(format_lines(lines))
                         print("User {} not found".format(name), file=sys.stderr)
@@ -132,69 +179,138 @@ def main():
         elif args.type == 'permission-sets':
             if not args.value:
                 parser.error("Permission set name is required")
-            lookup = PermissionSetArnLookup(sso_admin_client, ids)
-            lines = []
-            for name in args.value:
-                try:
-                    permission_set_arn = lookup.lookup_permission_set_arn(name)
-                except LookupError as e:
-                    if args.error_if_not_found:
-                        print(format_lines(lines))
-                        print("Permission set {} not found".format(name), file=sys.stderr)
-                        sys.exit(1)
-                    permission_set_arn = 'NOT_FOUND'
-                lines.append((name, permission_set_arn))
-            print(format_lines(lines))
+            lookup = PermissionSetArnLookup(sso_admin_client, ids, cache=cache)
+            try:
+                if sum(1 for name in args.value if name not in lookup.cache) > 1:
+                    lookup.prefetch_all()
+                lines = []
+                for name in args.value:
+                    try:
+                        permission_set_arn = lookup.lookup_permission_set_arn(name)
+                    except LookupError as e:
+                        if args.error_if_not_found:
+                            print(format_lines(lines))
+                            print("Permission set {} not found".format(name), file=sys.stderr)
+                            sys.exit(1)
+                        permission_set_arn = 'NOT_FOUND'
+                    lines.append((name, permission_set_arn))
+                print(format_lines(lines))
+            finally:
+                lookup.close()
 
     except LookupError as e:
         print(e, file=sys.stderr)
         sys.exit(1)
 
 def format_lines(lines):
-    max_len = max(len(l[0]) for l in lines)
-    return '\n'.join("{}: {}".format(l[0].ljust(max_len), l[1]) for l in lines)
+    max_len = max((len(name) for name, _ in lines), default=0)
+    return '\n'.join(f"{name:<{max_len}}: {value}" for name, value in lines)
 
 def lookup_group_by_name(identity_store_client, ids, name):
-    filters=[{'AttributePath': 'DisplayName', 'AttributeValue': name}]
+    from botocore.exceptions import ClientError
+    alternate_identifier = {'UniqueAttribute': {'AttributePath': 'DisplayName', 'AttributeValue': name}}
     try:
-        response = identity_store_client.list_groups(IdentityStoreId=ids.identity_store_id, Filters=filters)
-        if len(response['Groups']) == 0:
+        response = identity_store_client.get_group_id(IdentityStoreId=ids.identity_store_id, AlternateIdentifier=alternate_identifier)
+        return response['GroupId']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
             raise LookupError("No group named {} found".format(name))
-        elif len(response['Groups']) > 1:
-            raise LookupError("{} groups named {} found".format(len(response['Groups']), name))
-        return response['Groups'][0]['GroupId']
-    except:
         raise
 
 def lookup_user_by_name(identity_store_client, ids, name):
-    filters=[{'AttributePath': 'UserName', 'AttributeValue': name}]
+    from botocore.exceptions import ClientError
+    alternate_identifier = {'UniqueAttribute': {'AttributePath': 'UserName', 'AttributeValue': name}}
     try:
-        response = identity_store_client.list_users(IdentityStoreId=ids.identity_store_id, Filters=filters)
-        if len(response['Users']) == 0:
+        response = identity_store_client.get_user_id(IdentityStoreId=ids.identity_store_id, AlternateIdentifier=alternate_identifier)
+        return response['UserId']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
             raise LookupError("No user named {} found".format(name))
-        elif len(response['Users']) > 1:
-            raise LookupError("{} users named {} found".format(len(response['Users']), name))
-        return response['Users'][0]['UserId']
-    except:
         raise
 
+def _lookup_bulk(lookup_by_name, list_all, names):
+    if len(names) <= BULK_LOOKUP_THRESHOLD:
+        ids_by_name = {}
+        for name in names:
+            try:
+                ids_by_name[name] = lookup_by_name(name)
+            except LookupError:
+                pass
+        return ids_by_name
+    all_ids_by_name = list_all()
+    return {name: all_ids_by_name[name] for name in names if name in all_ids_by_name}
+
+def lookup_groups_bulk(identity_store_client, ids, names):
+    identity_store_id = ids.identity_store_id
+    def list_all():
+        paginator = identity_store_client.get_paginator('list_groups')
+        return {group['DisplayName']: group['GroupId']
+                for response in paginator.paginate(IdentityStoreId=identity_store_id)
+                for group in response['Groups']}
+    return _lookup_bulk(lambda name: lookup_group_by_name(identity_store_client, ids, name), list_all, names)
+
+def lookup_users_bulk(identity_store_client, ids, names):
+    identity_store_id = ids.identity_store_id
+    def list_all():
+        paginator = identity_store_client.get_paginator('list_users')
+        return {user['UserName']: user['UserId']
+                for response in paginator.paginate(IdentityStoreId=identity_store_id)
+                for user in response['Users']}
+    return _lookup_bulk(lambda name: lookup_user_by_name(identity_store_client, ids, name), list_all, names)
+
 class PermissionSetArnLookup:
-    def __init__(self, sso_admin_client, ids):
+    def __init__(self, sso_admin_client, ids, cache=None):
         self.client = sso_admin_client
         self.paginator = self.client.get_paginator('list_permission_sets')
         self.instance_arn = ids.instance_arn
+        self._disk_cache = cache
+        self._disk_cache_key = 'permission-sets:{}'.format(self.instance_arn)
         self.cache = {}
+        if self._disk_cache:
+            self.cache.update(self._disk_cache.load(self._disk_cache_key) or {})
+        self._prefetched = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=DESCRIBE_PERMISSION_SET_WORKERS)
+
+    def _persist(self):
+        if self._disk_cache:
+            self._disk_cache.store(self._disk_cache_key, self.cache)
+
+    def _describe_permission_set(self, permission_set_arn):
+        ps_description = self.client.describe_permission_set(InstanceArn=self.instance_arn, PermissionSetArn=permission_set_arn)
+        return ps_description['PermissionSet']['Name'], permission_set_arn
+
+    def prefetch_all(self):
+        # Describes for every page are in flight while later pages are listed
+        futures = [self._executor.submit(self._describe_permission_set, permission_set_arn)
+                   for response in self.paginator.paginate(InstanceArn=self.instance_arn)
+                   for permission_set_arn in response['PermissionSets']]
+        self.cache = dict(future.result() for future in futures)
+        self._prefetched = True
+        self._persist()
 
     def lookup_permission_set_arn(self, name):
         if name in self.cache:
             return self.cache[name]
+        if self._prefetched:
+            raise LookupError("No permission set named {} found".format(name))
         for response in self.paginator.paginate(InstanceArn=self.instance_arn):
-            for permission_set_arn in response['PermissionSets']:
-                ps_description = self.client.describe_permission_set(InstanceArn=self.instance_arn, PermissionSetArn=permission_set_arn)
-                self.cache[ps_description['PermissionSet']['Name']] = permission_set_arn
-            if name in self.cache:
-                return self.cache[name]
+            futures = [self._executor.submit(self._describe_permission_set, arn) for arn in response['PermissionSets']]
+            for future in concurrent.futures.as_completed(futures):
+                ps_name, permission_set_arn = future.result()
+                self.cache[ps_name] = permission_set_arn
+                if ps_name == name:
+                    for other_future in futures:
+                        other_future.cancel()
+                    self._persist()
+                    return permission_set_arn
         raise LookupError("No permission set named {} found".format(name))
 
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def __del__(self):
+        if hasattr(self, '_executor'):
+            self.close()
+
 if __name__ == '__main__':
     main()
@@ -1,15 +1,21 @@
 import argparse
+import concurrent.futures
 import configparser
+import functools
 import itertools
 import collections
 import json
 import sys
 
-import boto3
+# boto3 and yaml are slow to import, so they're imported where they're used
+# to keep --help and argument errors fast.
 
-import yaml
+from .cache import Cache
+from .lookup import list_instances
 
 def represent_ordereddict(dumper, data):
+    import yaml
+
     value = []
 
     for item_key, item_value in data.items():
@@ -20,8 +26,18 @@ def represent_ordereddict(dumper, data):
 
     return yaml.nodes.MappingNode(u'tag:yaml.org,2002:map', value)
 
-yaml.add_representer(collections.OrderedDict, represent_ordereddict)
-yaml.Dumper.ignore_aliases = lambda *args : True
+@functools.lru_cache(maxsize=None)
+def _register_yaml():
+    import yaml
+
+    # Prefer the libyaml emitter when PyYAML was built with it
+    Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
+    yaml.add_representer(collections.OrderedDict, represent_ordereddict, Dumper=Dumper)
+    yaml.add_representer(dict, represent_ordereddict, Dumper=Dumper)
+    Dumper.ignore_aliases = lambda *args : True
+
+    return Dumper
 
 PRINCIPAL_TYPE_GROUP = 'GROUP'
 PRINCIPAL_TYPE_USER = 'USER'
@@ -30,10 +46,14 @@ TARGET_TYPE_ACCOUNT = 'AWS_ACCOUNT'
 
 MAX_RESOURCES_PER_TEMPLATE = 200
 
+ORGANIZATIONS_WORKERS = 16
+
 REF_PREFIX = '!Ref='
 
 Input = collections.namedtuple('Input', ['groups', 'users', 'permission_sets', 'ous', 'accounts'])
 
+Assignments = collections.namedtuple('Assignments', ['instance_arn', 'principals', 'permission_set_arns', 'targets'])
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -41,6 +61,8 @@ def main():
 
     parser.add_argument('--instance', '-i', help="If not provided, will be retrieved from your account")
 
+    parser.add_argument('--refresh-cache', action='store_true', help="Ignore and replace the cached SSO instance lookup")
+
     principal_group = parser.add_argument_group("Principals")
     principal_group.add_argument('--groups', '-g', nargs='+', default=[])
     principal_group.add_argument('--users', '-u', nargs='+', default=[])
@@ -80,15 +102,22 @@ def main():
     if not input.ous and not input.accounts:
         parser.error("Provide at least one target (OU or account)")
 
+    if args.max_resources_per_template < 1:
+        parser.error("--max-resources-per-template must be at least 1")
+
     session = [None]
     def get_session():
         if not session[0]:
+            import boto3
             session[0] = boto3.Session(profile_name=args.profile)
         return session[0]
 
     try:
         if not args.instance:
-            response = get_session().client('sso-admin').list_instances()
+            cache = Cache.for_session(get_session())
+            if args.refresh_cache:
+                cache.clear()
+            response = list_instances(get_session().client('sso-admin'), cache)
             if len(response['Instances']) == 0:
                 parser.error("No SSO instance found, please specify with --instance")
             elif len(response['Instances']) > 1:
@@ -99,14 +128,19 @@ def main():
                 print("Using SSO instance {}".format(instance_id))
                 args.instance = instance_arn
 
-        if input.ous:
-            organizations_client = get_session().client('organizations')
-            ou_fetcher = lambda ou: get_accounts_for_ou(organizations_client, ou)
-        else:
-            ou_fetcher = lambda ou: []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ORGANIZATIONS_WORKERS) as executor:
+            if input.ous:
+                organizations_client = get_session().client('organizations')
+                ou_cache = ({}, {})
+                @functools.lru_cache(maxsize=None)
+                def ou_fetcher(ou):
+                    return tuple(get_accounts_for_ou(organizations_client, ou, executor, ou_cache))
+            else:
+                ou_fetcher = lambda ou: []
 
-        templates = get_templates(args.instance, input, ou_fetcher, args.max_resources_per_template)
-        if len(templates) == 1:
+            assignments = get_assignments(args.instance, input, ou_fetcher)
+        num_templates = get_num_templates(assignments, args.max_resources_per_template)
+        if num_templates == 1:
             if not args.template_file:
                 args.template_file = 'template.yaml'
                 print("Outputting to {}".format(args.template_file))
@@ -115,12 +149,14 @@ def main():
             if not args.template_file:
                 args.template_file = 'template.yaml'
             prefix, suffix = args.template_file.rsplit('.', 1)
-            template_file_names = ["{}{:02d}.{}".format(prefix, num+1, suffix) for num in range(len(templates))]
+            template_file_names = ["{}{:02d}.{}".format(prefix, num+1, suffix) for num in range(num_templates)]
             print("Outputting to {} through {}".format(template_file_names[0], template_file_names[-1]))
 
-        for template_file_name, template in zip(template_file_names, templates):
+        import yaml
+        Dumper = _register_yaml()
+        for template_file_name, template in zip(template_file_names, iter_templates(assignments, args.max_resources_per_template)):
             with open(template_file_name, 'w') as fp:
-                yaml.dump(template, fp)
+                yaml.dump(template, fp, Dumper=Dumper)
 
     except Exception as e:
         print(str(e), file=sys.stderr)
@@ -161,23 +197,34 @@ def load_file(fp, parser):
     return instance, Input(groups, users, permission_sets, ous, accounts)
 
 def get_resource(instance_arn, principal, permission_set_arn, target):
-    return collections.OrderedDict({
+    return {
         "Type" : "AWS::SSO::Assignment",
-        "Properties" : collections.OrderedDict({
+        "Properties" : {
                 "InstanceArn" : instance_arn,
                 "PrincipalType" : principal[0],
                 "PrincipalId" : principal[1],
                 "PermissionSetArn" : permission_set_arn,
                 "TargetType" : target[0],
                 "TargetId" : target[1],
-            })
-        })
-
-def chunk_list_generator(lst, chunk_length):
-    for i in range(0, len(lst), chunk_length):
-        yield lst[i:i + chunk_length]
+            }
+        }
+
+def resolve_ref(value):
+    if value.startswith(REF_PREFIX):
+        return {"Ref": value[len(REF_PREFIX):]}
+    return value
+
+def get_permission_set_arn(instance_id, permission_set):
+    if permission_set.startswith('arn'):
+        return permission_set
+    elif permission_set.startswith(REF_PREFIX):
+        return {"Ref": permission_set[len(REF_PREFIX):]}
+    elif permission_set.startswith(('ssoins', 'ins')):
+        return 'arn:aws:sso:::permissionSet/{}'.format(permission_set)
+    else:
+        return 'arn:aws:sso:::permissionSet/{}/{}'.format(instance_id, permission_set)
 
-def get_templates(instance, input, ou_fetcher, max_resources_per_template):
+def get_assignments(instance, input, ou_fetcher):
     if instance.startswith('arn'):
         instance_arn = instance
     else:
@@ -191,51 +238,90 @@ def get_templates(instance, input, ou_fetcher, max_resources_per_template):
         targets.extend((TARGET_TYPE_ACCOUNT, account) for account in ou_fetcher(ou))
     targets.extend((TARGET_TYPE_ACCOUNT, account) for account in input.accounts)
 
-    resources = []
-
-    index = 1
-    for principal in principals:
-        if principal[1].startswith(REF_PREFIX):
-            principal = (principal[0], {"Ref": principal[1][len(REF_PREFIX):]})
-        for permission_set in input.permission_sets:
-            if permission_set.startswith('arn'):
-                permission_set_arn = permission_set
-            elif permission_set.startswith(REF_PREFIX):
-                permission_set_arn = {"Ref": permission_set[len(REF_PREFIX):]}
-            elif permission_set.startswith('ssoins') or permission_set.startswith('ins'):
-                permission_set_arn = 'arn:aws:sso:::permissionSet/{}'.format(permission_set)
-            else:
-                permission_set_arn = 'arn:aws:sso:::permissionSet/{}/{}'.format(instance_id, permission_set)
-            for target in targets:
-                if target[1].startswith(REF_PREFIX):
-                    target = (target[0], {"Ref": target[1][len(REF_PREFIX):]})
-                resource_name = 'Assignment{:03d}'.format(index)
+    # Duplicate assignments would be rejected by CloudFormation
+    principals = list(dict.fromkeys(principals))
+    permission_sets = list(dict.fromkeys(input.permission_sets))
+    targets = list(dict.fromkeys(targets))
+
+    principals = [(principal_type, resolve_ref(principal_id)) for principal_type, principal_id in principals]
+    permission_set_arns = [get_permission_set_arn(instance_id, permission_set) for permission_set in permission_sets]
+    targets = [(target_type, resolve_ref(target_id)) for target_type, target_id in targets]
 
-                resources.append((resource_name, get_resource(instance_arn, principal, permission_set_arn, target)))
+    return Assignments(instance_arn, principals, permission_set_arns, targets)
 
-                index += 1
+def get_num_templates(assignments, max_resources_per_template):
+    num_resources = len(assignments.principals) * len(assignments.permission_set_arns) * len(assignments.targets)
+    return -(-num_resources // max_resources_per_template)
 
-    templates = [collections.OrderedDict({
-        "AWSTemplateFormatVersion": "2010-09-09",
-        "Resources": collections.OrderedDict(rsc),
-    }) for rsc in chunk_list_generator(resources, max_resources_per_template)]
+def iter_templates(assignments, max_resources_per_template):
+    resources = (
+        ('Assignment{:03d}'.format(index), get_resource(assignments.instance_arn, principal, permission_set_arn, target))
+        for index, (principal, permission_set_arn, target) in enumerate(itertools.product(assignments.principals, assignments.permission_set_arns, assignments.targets), 1)
+    )
 
-    return templates
+    while True:
+        rsc = dict(itertools.islice(resources, max_resources_per_template))
+        if not rsc:
+            return
+        yield {
+            "AWSTemplateFormatVersion": "2010-09-09",
+            "Resources": rsc,
+        }
 
-def get_accounts_for_ou(organizations_client, ou):
-    accounts = []
+def get_templates(instance, input, ou_fetcher, max_resources_per_template):
+    return list(iter_templates(get_assignments(instance, input, ou_fetcher), max_resources_per_template))
 
+def _list_sub_ous(organizations_client, ou):
     paginator = organizations_client.get_paginator('list_organizational_units_for_parent')
-    for response in paginator.paginate(ParentId=ou):
-        sub_ous = [data['Id'] for data in response['OrganizationalUnits']]
-        for sub_ou_id in sub_ous:
-            accounts.extend(get_accounts_for_ou(organizations_client, sub_ou_id))
+    return [data['Id'] for response in paginator.paginate(ParentId=ou) for data in response['OrganizationalUnits']]
 
+def _list_accounts(organizations_client, ou):
     paginator = organizations_client.get_paginator('list_accounts_for_parent')
-    for response in paginator.paginate(ParentId=ou):
-        accounts.extend(data['Id'] for data in response['Accounts'])
+    return [data['Id'] for response in paginator.paginate(ParentId=ou) for data in response['Accounts']]
+
+def get_accounts_for_ou(organizations_client, ou, executor=None, ou_cache=None):
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ORGANIZATIONS_WORKERS) as executor:
+            return get_accounts_for_ou(organizations_client, ou, executor, ou_cache)
+
+    # ou_cache is a (sub_ous, accounts) pair of dicts keyed by OU id that can
+    # be shared between calls so overlapping subtrees are only listed once.
+    if ou_cache is None:
+        ou_cache = ({}, {})
+    sub_ous, accounts = ou_cache
+    pending = {}
+
+    def submit(ou_id):
+        if ou_id in sub_ous:
+            return
+        pending[executor.submit(_list_sub_ous, organizations_client, ou_id)] = (sub_ous, ou_id)
+        pending[executor.submit(_list_accounts, organizations_client, ou_id)] = (accounts, ou_id)
+
+    # Walk the tree breadth-first, issuing calls for each OU as soon as it's
+    # discovered so the pool stays saturated across levels.
+    submit(ou)
+    while pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            results, ou_id = pending.pop(future)
+            results[ou_id] = future.result()
+            if results is sub_ous:
+                for sub_ou_id in results[ou_id]:
+                    submit(sub_ou_id)
+
+    # Assemble in depth-first order (sub-OU accounts before the OU's own)
+    # so output doesn't depend on which calls finished first.
+    ou_accounts = []
+    stack = [(ou, False)]
+    while stack:
+        ou_id, expanded = stack.pop()
+        if expanded:
+            ou_accounts.extend(accounts[ou_id])
+        else:
+            stack.append((ou_id, True))
+            stack.extend((sub_ou_id, False) for sub_ou_id in reversed(sub_ous[ou_id]))
 
-    return accounts
+    return ou_accounts
 
 if __name__ == '__main__':
     main()